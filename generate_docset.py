@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 from curses import get_tabsize
+import hashlib
+import io
 import itertools
-import json
+import os
 import re
 import shutil
 import sqlite3
@@ -9,22 +11,33 @@ import subprocess
 import sys
 import urllib.parse
 from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
+import ahocorasick
+import hishel
+import httpx
 import json5
-import requests
-from bs4 import BeautifulSoup
-from bs4.element import Comment, Tag
+import lxml.etree
+import orjson
+from selectolax.parser import HTMLParser, Node
 from tqdm import tqdm, trange
 
 # Make sure to keep these updated for new versions of Dyalog. Both of these are
 # used to patch and run the hlp.js to get better symbol help.
 CURRENT_VERSION = "18.0"
 HLP_JS_URL = "https://raw.githubusercontent.com/Dyalog/ride/aa40802d01adf1410a9a9af14149437961e5389c/src/hlp.js"
+# Force extracting the RIDE help table by executing hlp.js under Node.js
+# instead of statically parsing the D.hlp literal out of the source. Slower
+# and needs node installed, but survives upstream restructuring of hlp.js.
+# The static path also falls back to node on its own when parsing fails.
+RIDE_HELP_USE_NODE = False
 
 BASE_URL = "https://help.dyalog.com/latest"
+DOWNLOAD_WORKERS = 32
 DOCSET_DIR = Path("Dyalog APL.docset")
 RESOURCES_DIR = DOCSET_DIR / "Contents" / "Resources"
 DOCUMENTS_DIR = RESOURCES_DIR / "Documents"
@@ -71,6 +84,33 @@ ENTRY_TYPES = {
     # This is basically only for the RIDE help.
     "Language/Symbols": "Notation",
 }
+# Aho-Corasick automaton over the ENTRY_TYPES keys: matching is one pass over
+# the path instead of a substring search per key.
+ENTRY_TYPE_AUTOMATON = ahocorasick.Automaton()
+for _key, _value in ENTRY_TYPES.items():
+    ENTRY_TYPE_AUTOMATON.add_word(_key, _value)
+ENTRY_TYPE_AUTOMATON.make_automaton()
+
+JSONP_RE = re.compile(r"define\((.*)\)", re.DOTALL)
+WHITESPACE_RE = re.compile(r"\s+")
+HLP_OBJECT_RE = re.compile(r"D\.hlp\s*=\s*\{")
+INTERPOLATION_RE = re.compile(r"\$\{[^}]*\}")
+UNWANTED_HEADINGS = frozenset({"example", "examples"})
+
+
+# A shared client so parallel downloads get multiplexed over a few pooled
+# HTTP/2 connections instead of paying a handshake per request. Responses are
+# cached on disk for a day, turning re-runs into cache hits or cheap
+# conditional GETs instead of full downloads.
+CLIENT = hishel.CacheClient(
+    http2=True,
+    follow_redirects=True,
+    limits=httpx.Limits(
+        max_connections=DOWNLOAD_WORKERS, max_keepalive_connections=DOWNLOAD_WORKERS
+    ),
+    storage=hishel.FileStorage(base_path=TMP_DIR / "http_cache", ttl=86400),
+    controller=hishel.Controller(allow_heuristics=True),
+)
 
 
 def download_jsonp(path: str) -> Any:
@@ -78,28 +118,87 @@ def download_jsonp(path: str) -> Any:
     Download and parse a jsonp file.
     """
     url = f"{BASE_URL}{path}"
-    r = requests.get(url)
+    r = CLIENT.get(url)
     r.raise_for_status()
-    jsonp = re.search(r"define\((.*)\)", r.text)[1]
+    jsonp = JSONP_RE.search(r.text)[1]
     return json5.loads(jsonp)
 
 
 def download_document(path: str) -> Path:
     """
-    Download a document into the tmp directory if necessary.
+    Download a document into the tmp directory. Freshness is handled by the
+    client's HTTP cache. Safe to call from multiple threads as long as the
+    paths are distinct.
     """
     tmp_path = TMP_DIR / Path(path).relative_to("/")
-    if not tmp_path.exists():
-        tmp_path.parent.mkdir(parents=True, exist_ok=True)
-        url = f"{BASE_URL}{path}"
-        r = requests.get(url)
+    tmp_path.parent.mkdir(parents=True, exist_ok=True)
+    url = f"{BASE_URL}{path}"
+    with CLIENT.stream("GET", url) as r:
         r.raise_for_status()
         with open(tmp_path, "wb") as fd:
-            for chunk in r.iter_content(chunk_size=128):
+            for chunk in r.iter_bytes(chunk_size=1 << 20):
                 fd.write(chunk)
     return tmp_path
 
 
+def copy_asset(src: Path, dst: Path) -> None:
+    """
+    Copy a downloaded asset into the docset, using the in-kernel sendfile
+    copy where available.
+    """
+    try:
+        with open(src, "rb") as src_fd, open(dst, "wb") as dst_fd:
+            remaining = os.fstat(src_fd.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                sent = os.sendfile(dst_fd.fileno(), src_fd.fileno(), offset, remaining)
+                offset += sent
+                remaining -= sent
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+
+
+def parse_hlp_js(source: str) -> Any:
+    """
+    Statically extract the D.hlp object literal from hlp.js. The literal is
+    json5 apart from template-string interpolations, which we substitute with
+    CURRENT_VERSION (only the URL fragment after # is ever used, so the exact
+    version prefix doesn't matter). Returns None if the source stopped looking
+    like we expect.
+    """
+    match = HLP_OBJECT_RE.search(source)
+    if not match:
+        return None
+    # Scan for the matching closing brace, skipping string contents.
+    start = match.end() - 1
+    depth = 0
+    quote = None
+    i = start
+    while i < len(source):
+        c = source[i]
+        if quote is not None:
+            if c == "\\":
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in "'\"`":
+            quote = c
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                break
+        i += 1
+    else:
+        return None
+    literal = INTERPOLATION_RE.sub(CURRENT_VERSION, source[start : i + 1])
+    try:
+        return json5.loads(literal.replace("`", '"'))
+    except ValueError:
+        return None
+
+
 def scrape_ride_help() -> dict[str, str]:
     """
     Get the symbol to page mapping used for RIDE F1-help functionality in the
@@ -107,17 +206,19 @@ def scrape_ride_help() -> dict[str, str]:
     Dash.  We could carefully scrape a few select pages to get the symbols
     instead but this takes care of figuring out what to scrape.
     """
-    path = TMP_DIR / "hlp.js"
-    if not path.exists():
-        r = requests.get(HLP_JS_URL)
-        r.raise_for_status()
+    r = CLIENT.get(HLP_JS_URL)
+    r.raise_for_status()
+    raw_help = None if RIDE_HELP_USE_NODE else parse_hlp_js(r.text)
+    if raw_help is None:
+        # Run the patched script under node, paying JS-engine startup cost.
+        path = TMP_DIR / "hlp.js"
         patched = (
             "D={aboutDetails: () => ''}\n"
             + r.text
             + f"D.InitHelp('{CURRENT_VERSION}')\n;console.log(JSON.stringify(D.hlp));"
         )
         path.write_text(patched)
-    raw_help = json.loads(subprocess.check_output(["node", str(path)]))
+        raw_help = orjson.loads(subprocess.check_output(["node", str(path)]))
     # Filter out all the stuff that doesn't lead to the docs.
     ride_help = {}
     for title, url in raw_help.items():
@@ -132,10 +233,10 @@ def get_json_or_create(path: str, create: Callable[[], Any]) -> Any:
     Cache the result of the create call as a json file in the tmp directory.
     """
     try:
-        return json.loads((TMP_DIR / path).read_text())
+        return orjson.loads((TMP_DIR / path).read_bytes())
     except FileNotFoundError:
         data = create()
-        (TMP_DIR / path).write_text(json.dumps(data))
+        (TMP_DIR / path).write_bytes(orjson.dumps(data))
         return data
 
 
@@ -164,62 +265,91 @@ def get_entry_type(path: str, title: str) -> str:
     if "UserGuide/Installation and Configuration/Configuration Parameters" in path:
         return "Setting"
     # Crashes if no entry type is found.
-    return next(v for k, v in ENTRY_TYPES.items() if k in path)
+    return next(ENTRY_TYPE_AUTOMATON.iter(path))[1]
 
 
-def is_relative_href(href: str | None) -> bool:
-    return (
-        href is not None
-        and not urllib.parse.urlparse(href).netloc
+@lru_cache(maxsize=1 << 16)
+def parse_href(href: str) -> tuple[bool, str, str]:
+    """
+    Split an href into (is_relative, base, fragment). Cached because stdlib
+    URL parsing is pure Python and the same hrefs (navigation, breadcrumbs)
+    repeat across many pages.
+    """
+    base, frag = urllib.parse.urldefrag(href)
+    is_relative = (
+        not urllib.parse.urlparse(href).netloc
         and not href.startswith("javascript:")
         and not href.startswith("mailto:")
     )
+    return is_relative, base, frag
+
 
+def is_relative_href(href: str | None) -> bool:
+    return href is not None and parse_href(href)[0]
 
-def is_section_heading(element: Tag) -> bool:
-    if element.name in ["h4", "h5"]:  # h3 is the top heading.
-        unwanted_headings = ["example", "examples"]
-        return clean_heading_name(element.get_text()).lower() not in unwanted_headings
-    return element.name == "p" and "TableCaption" in element.get("class", [])
+
+# Matches candidate section headings; h3 is the top heading.
+SECTION_SELECTOR = "h4, h5, p.TableCaption"
+
+
+def is_section_heading(node: Node) -> bool:
+    if node.tag in ["h4", "h5"]:
+        return clean_heading_name(node.text()).lower() not in UNWANTED_HEADINGS
+    return True  # p.TableCaption, already filtered by SECTION_SELECTOR.
 
 
 def clean_heading_name(heading: str) -> str:
-    return re.sub(r"\s+", " ", heading.strip()).removesuffix(":")
+    return WHITESPACE_RE.sub(" ", heading.strip()).removesuffix(":")
 
 
-def sanitize_html(soup: BeautifulSoup) -> None:
+def sanitize_html(tree: HTMLParser) -> None:
     """
     Process the html to make it ready for Dash.
     """
     # Remove the "Open topic with navigation" link and breadcrumbs.
-    for el in soup(class_=["MCWebHelpFramesetLinkTop", "breadcrumbs"]):
-        el.extract()
+    for el in tree.css(".MCWebHelpFramesetLinkTop, .breadcrumbs"):
+        el.decompose()
 
     # Remove all script tags.
-    del soup.body["onload"]
-    for script in soup("script"):
-        script.extract()
+    if tree.body is not None and "onload" in tree.body.attrs:
+        del tree.body.attrs["onload"]
+    for script in tree.css("script"):
+        script.decompose()
 
     # Patch all relative links to point to new .html pages (instead of .htm).
-    for link in soup("a", href=is_relative_href):
-        link["href"] = link["href"].replace(".htm", ".html")
+    for link in tree.css("a[href]"):
+        href = link.attrs["href"]
+        if is_relative_href(href):
+            link.attrs["href"] = href.replace(".htm", ".html")
 
     # Add Dash anchors (removing consecutive duplicates since otherwise jumping
-    # in Dash is broken). Use get_text(), since string returns None if there are
-    # any elements in the heading.
+    # in Dash is broken).
     sections = [
         next(v)
         for _, v in itertools.groupby(
-            soup(is_section_heading),
-            key=lambda x: clean_heading_name(x.get_text()),
+            filter(is_section_heading, tree.css(SECTION_SELECTOR)),
+            key=lambda x: clean_heading_name(x.text()),
         )
     ]
     if len(sections) >= 2:
         for section in sections:
             # Use safe="" to make sure a slash can't appear in the name.
-            name = urllib.parse.quote(clean_heading_name(section.get_text()), safe="")
+            name = urllib.parse.quote(clean_heading_name(section.text()), safe="")
             anchor = f"<a name='//apple_ref/cpp/Section/{name}' class='dashAnchor'></a>"
-            section.insert_before(BeautifulSoup(anchor, "html.parser"))
+            section.insert_before(HTMLParser(anchor).css_first("a"))
+
+
+def serialize_page(tree: HTMLParser, page: str) -> bytes:
+    """
+    Serialize a sanitized page, prepending the comment used by Dash's Open
+    Online Page feature. All mutations happen on the tree; this is the only
+    point where it is converted to bytes.
+    """
+    param = page.removeprefix("/Content/")
+    comment = f"<!--Online page at https://help.dyalog.com/latest/#{param}-->"
+    # Encode the parts separately so the whole document never exists as both
+    # a concatenated str and its encoded bytes at the same time.
+    return comment.encode("utf-8") + tree.html.encode("utf-8")
 
 
 @dataclass
@@ -228,61 +358,117 @@ class DownloadQueues:
     assets: set[str] = field(default_factory=set)
 
 
+def extract_refs(html: bytes) -> Iterator[tuple[str, str]]:
+    """
+    Stream (tag, reference) pairs for <a href>, stylesheet <link href> and
+    <img src> from a page without building a full document tree.
+    """
+    for _, el in lxml.etree.iterparse(
+        io.BytesIO(html), events=("end",), html=True, tag=("a", "link", "img")
+    ):
+        if el.tag == "a":
+            ref = el.get("href")
+        elif el.tag == "link":
+            ref = el.get("href") if el.get("rel") == "stylesheet" else None
+        else:
+            ref = el.get("src")
+        if ref is not None:
+            yield el.tag, ref
+        el.clear()
+
+
 def resolve_url(page: str, href: str) -> str:
-    base, frag = urllib.parse.urldefrag(href)
+    _, base, frag = parse_href(href)
     if "../index.htm" in base:
         return "/Content/" + frag  # _top redirct.
     else:
         return urllib.parse.urljoin(page, base)
 
 
-def download_and_process_page(page: str, queues: DownloadQueues) -> str:
+def fetch_page(page: str) -> bytes:
     """
-    Download a page, extract all the data we need, sanitize it and write it to
-    the docset folder. Returns the page title.
+    The I/O half of page processing: download a page and return its bytes.
     """
-    tmp_path = download_document(page)
-    # Change suffix to .html, if we don't Dash dosen't display titles properly.
-    docset_path = (DOCUMENTS_DIR / tmp_path.relative_to(TMP_DIR)).with_suffix(".html")
-    docset_path.parent.mkdir(exist_ok=True, parents=True)
-    with open(tmp_path) as fd:
-        soup = BeautifulSoup(fd, "html.parser")
+    return download_document(page).read_bytes()
 
-    # Get links and assets before we sanitize them.
-    queues.pages.update(
-        resolve_url(page, x["href"]) for x in soup("a", href=is_relative_href)
-    )
-    queues.assets.update(
-        resolve_url(page, x["href"]) for x in soup("link", rel="stylesheet")
-    )
-    queues.assets.update(resolve_url(page, x["src"]) for x in soup("img"))
 
-    sanitize_html(soup)
-    # Support Online Redirection.
-    param = page.removeprefix("/Content/")
-    comment = f"Online page at https://help.dyalog.com/latest/#{param}"
-    soup.html.insert(0, Comment(comment))
-    docset_path.write_text(str(soup))
-    return soup.title.string
+def parse_page(page: str, html: bytes) -> tuple[str, set[str], set[str], bytes]:
+    """
+    The CPU half of page processing, safe to run in a worker process. Returns
+    the page title, the discovered links and assets, and the serialized page.
+    """
+    # Get links and assets with a streaming pre-pass; only sanitizing below
+    # needs the full tree.
+    links = set()
+    assets = set()
+    for tag, ref in extract_refs(html):
+        if tag == "a":
+            if is_relative_href(ref):
+                links.add(resolve_url(page, ref))
+        else:
+            assets.add(resolve_url(page, ref))
+
+    tree = HTMLParser(html)
+    sanitize_html(tree)
+    return tree.css_first("title").text(), links, assets, serialize_page(tree, page)
+
+
+def write_page(page: str, html: bytes) -> None:
+    """
+    Write a serialized page into the docset folder. Skips the write when the
+    existing file is byte-identical, which is the common case on incremental
+    runs, so unchanged pages don't get dirtied.
+    """
+    # Change suffix to .html, if we don't Dash dosen't display titles properly.
+    docset_path = DOCUMENTS_DIR / Path(page).relative_to("/")
+    docset_path = docset_path.with_suffix(".html")
+    docset_path.parent.mkdir(exist_ok=True, parents=True)
+    if (
+        docset_path.exists()
+        and docset_path.stat().st_size == len(html)
+        and hashlib.blake2b(docset_path.read_bytes()).digest()
+        == hashlib.blake2b(html).digest()
+    ):
+        return
+    docset_path.write_bytes(html)
 
 
 def crawl_pages(queues: DownloadQueues) -> Iterator[tuple[str, str]]:
     """
-    Crawl the pages from the provided page queue.
+    Crawl the pages from the provided page queue. Each wave of the frontier is
+    fetched in parallel by threads and parsed in parallel by worker processes;
+    only frontier bookkeeping and file writes stay on the main thread.
     """
     done_pages = {"/index.htm"}  # Prevents it from ever being downloaded.
-    progess = tqdm(total=len(queues.pages), desc="Pages")
-    while queues.pages:
-        page = queues.pages.pop()
-        try:
-            title = download_and_process_page(page, queues)
-            yield title, page
-        except requests.HTTPError as e:
-            progess.write(f"Download failed: {e}", file=sys.stderr)
-        done_pages.add(page)
-        queues.pages -= done_pages
-        progess.total = len(queues.pages) + len(done_pages)
-        progess.update()
+    progess = tqdm(total=len(queues.pages - done_pages), desc="Pages")
+    with (
+        ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as fetchers,
+        ProcessPoolExecutor() as parsers,
+    ):
+        while queues.pages:
+            frontier = queues.pages - done_pages
+            queues.pages.clear()
+            # Mark the whole wave as done up front so rediscovered links are
+            # dropped at discovery time instead of rescanning the frontier.
+            done_pages |= frontier
+            fetches = {fetchers.submit(fetch_page, page): page for page in frontier}
+            parses = {}
+            for future in as_completed(fetches):
+                page = fetches[future]
+                try:
+                    parses[parsers.submit(parse_page, page, future.result())] = page
+                except httpx.HTTPStatusError as e:
+                    progess.write(f"Download failed: {e}", file=sys.stderr)
+                    progess.update()
+            for future in as_completed(parses):
+                page = parses[future]
+                title, links, assets, html = future.result()
+                write_page(page, html)
+                queues.pages.update(u for u in links if u not in done_pages)
+                queues.assets |= assets
+                yield title, page
+                progess.update()
+            progess.total += len(queues.pages)
     progess.close()
 
 
@@ -291,20 +477,27 @@ def create_docset_index(*title_path_iterables: Iterable[tuple[str, str]]):
     Creates a new docset index from given iterables.
     """
     conn = sqlite3.connect(RESOURCES_DIR / "docSet.dsidx")
+    # The index is rebuilt from scratch every run, so recovery after a crash
+    # is just "rerun" and we can skip journaling and fsyncs entirely.
+    conn.execute("PRAGMA journal_mode=OFF;")
+    conn.execute("PRAGMA synchronous=OFF;")
     conn.execute("DROP TABLE IF EXISTS searchIndex;")
     conn.execute(
         "CREATE TABLE searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, path TEXT);"
     )
-    conn.execute("CREATE UNIQUE INDEX anchor ON searchIndex(name, type, path);")
-
-    for title, path in itertools.chain(*title_path_iterables):
-        path = path.removesuffix(".htm") + ".html"
-        conn.execute(
-            "INSERT OR IGNORE INTO searchIndex(name, type, path) VALUES (?, ?, ?)",
-            (title, get_entry_type(path, title), path),
+    # Dedupe in Python so no conflict handling is needed, then insert all rows
+    # and build the unique index once at the end — one sort-based index build
+    # is much cheaper than maintaining the B-tree on every insert.
+    rows = {
+        (title, get_entry_type(path, title), path)
+        for title, raw_path in itertools.chain(*title_path_iterables)
+        for path in [raw_path.removesuffix(".htm") + ".html"]
+    }
+    with conn:
+        conn.executemany(
+            "INSERT INTO searchIndex(name, type, path) VALUES (?, ?, ?)", rows
         )
-
-    conn.commit()
+    conn.execute("CREATE UNIQUE INDEX anchor ON searchIndex(name, type, path);")
     conn.close()
 
 
@@ -329,11 +522,13 @@ def main() -> None:
     create_docset_index(crawl_pages(queues), ride_help.items())
 
     # Download missing assets.
-    for asset in tqdm(list(queues.assets), "Assets"):
-        tmp_path = download_document(asset)
-        docset_path = DOCUMENTS_DIR / tmp_path.relative_to(TMP_DIR)
-        docset_path.parent.mkdir(exist_ok=True, parents=True)
-        shutil.copyfile(tmp_path, docset_path)
+    assets = list(queues.assets)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        downloads = executor.map(download_document, assets)
+        for tmp_path in tqdm(downloads, "Assets", total=len(assets)):
+            docset_path = DOCUMENTS_DIR / tmp_path.relative_to(TMP_DIR)
+            docset_path.parent.mkdir(exist_ok=True, parents=True)
+            copy_asset(tmp_path, docset_path)
 
 
 if __name__ == "__main__":